@@ -1,11 +1,20 @@
 import os
+import atexit
+import base64
+import copy
+import json
 import pickle
+import queue
 import re
-from zipfile import ZipFile, ZIP_STORED
-from PIL import Image
-from shutil import rmtree
-from time import sleep
-from typing import Optional, List
+import struct
+import threading
+import urllib.request
+from collections import deque
+from concurrent.futures import FIRST_EXCEPTION, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from zipfile import ZipFile, ZipInfo, ZIP_STORED
+from shutil import copyfileobj, rmtree
+from time import monotonic, sleep
+from typing import Optional, List, Tuple
 
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
@@ -14,9 +23,21 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
 from selenium.common.exceptions import TimeoutException, JavascriptException, NoSuchElementException
 
-from bs4 import BeautifulSoup as bs
+import lxml.html
 from tqdm import tqdm
 
+try:
+    import oxipng
+except ImportError:
+    # Optional, only needed for recompressing pages
+    oxipng = None
+
+try:
+    import websocket
+except ImportError:
+    # Optional, without it DevTools commands go through chromedriver
+    websocket = None
+
 
 BASE_URL = "https://www.fakku.net"
 LOGIN_URL = f"{BASE_URL}/login/"
@@ -27,6 +48,8 @@ FAIL_THRESHOLD = 1000
 MAX_DISPLAY_SETTINGS = [1440, 2560]
 # Path to headless driver
 EXEC_PATH = "chromedriver"
+# Path to Chrome binary, e.g. chrome-headless-shell (None == default Chrome)
+CHROME_PATH = None
 # File with manga urls
 URLS_FILE = "urls.txt"
 # File with completed urls
@@ -41,19 +64,182 @@ ROOT_MANGA_DIR = "manga"
 TIMEOUT = 5
 # Wait between page loading in seconds
 WAIT = 2
+# Sleep fixed time before each reader page instead of polling for rendered
+# canvas, set FAKKU_FIXED_WAIT=1 to get old behaviour
+FIXED_WAIT = bool(os.environ.get("FAKKU_FIXED_WAIT"))
+# Max screenshots waiting to be written on disk
+MAX_PENDING_WRITES = 2
+# Buffer size for copying pages into .cbz
+COPY_BUFFER_SIZE = 1024 * 1024
+# Optimization level of oxipng for recompressing pages (0-6)
+OXIPNG_LEVEL = 2
+# Number of done/failed urls buffered before they are written to file.
+# Done urls are not buffered when manga are packed into .cbz
+FLUSH_EVERY = 16
+# Timeout in seconds for direct DevTools connection
+DEVTOOLS_TIMEOUT = 30
 # Max manga to download in one session (-1 == no limit)
 MAX = None
+# Number of headless browsers downloading manga in parallel
+CONCURRENCY = 1
 # User agent for web browser
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36"
+# Obfuscation of headless browser, see FDownloader.init_browser
+STEALTH_JS = """
+(function() {
+  // overwrite the `languages` property to use a custom getter
+  Object.defineProperty(navigator, 'languages', {
+    get: function() {
+      return ['en-US', 'en'];
+    },
+  });
+
+  // overwrite the `plugins` property to use a custom getter
+  Object.defineProperty(navigator, 'plugins', {
+    get: function() {
+      // this just needs to have `length > 0`, but we could mock the plugins too
+      return [1, 2, 3, 4, 5];
+    },
+  });
+
+  // Spoof renderer checks
+  const getParameter = WebGLRenderingContext.prototype.getParameter;
+  WebGLRenderingContext.prototype.getParameter = function(parameter) {
+    // UNMASKED_VENDOR_WEBGL
+    if (parameter === 37445) {
+      return 'Intel Open Source Technology Center';
+    }
+    // UNMASKED_RENDERER_WEBGL
+    if (parameter === 37446) {
+      return 'Mesa DRI Intel(R) Ivybridge Mobile ';
+    }
+
+    return getParameter.call(this, parameter);
+  };
+})();
+"""
+# Precompiled patterns for parsing urls and html
+PAGE_COUNT_RE = re.compile(r"\"\>(\d+) page(s?)\<\/div\>")
+PAGE_LINK_RE = re.compile(r"href=\"[^\"]*\/page\/(\d+)")
+# Returns true when manga page canvas is rendered in full size and its
+# center pixel is drawn. If pixels can not be read (no 2d context or
+# reading is blocked), only size is checked.
+PAGE_READY_JS = """
+var layers = document.getElementsByClassName('layer');
+var canvas = document.getElementsByTagName('canvas')[layers.length - 2];
+if (!canvas || canvas.width < arguments[0] || canvas.height < arguments[0]) {
+  return false;
+}
+try {
+  var context = canvas.getContext('2d');
+  if (!context) {
+    return true;
+  }
+  var pixel = context.getImageData(canvas.width >> 1, canvas.height >> 1, 1, 1);
+  return pixel.data[3] > 0;
+} catch (e) {
+  return true;
+}
+"""
+# Returns [x, y, width, height] of manga page canvas on the page, then its real
+# [width, height], and removes UI layer.
+# Count of layers may be 2 or 3 therefore target layer is counted from end.
+# Reader iframe offset is added when frame is accessible, else frame is
+# expected to start at top left corner of page.
+PAGE_SIZE_JS = """
+var layers = document.getElementsByClassName('layer');
+var n = layers.length;
+var canvas = document.getElementsByTagName('canvas')[n - 2];
+var rect = canvas.getBoundingClientRect();
+var x = rect.left, y = rect.top;
+var frame = window.frameElement;
+if (frame) {
+  var frameRect = frame.getBoundingClientRect();
+  x += frameRect.left + frame.clientLeft + window.parent.scrollX;
+  y += frameRect.top + frame.clientTop + window.parent.scrollY;
+}
+var size = [x, y, rect.width, rect.height, canvas.width, canvas.height];
+layers[n - 1].remove();
+return size;
+"""
 
 def program_exit():
     print("Program exit.")
     exit()
 
 def sanitize_url(url: str) -> str:
-    # Sanitize url.
-    url = re.sub(r"\/read(\/page\/.+)?", "", url)
-    return url
+    # Sanitize url, cut reader part (/read or /read/page/N) off.
+    # "/read" has to be whole path segment, slugs may start with "read".
+    if url.endswith("/read"):
+        return url[:-5]
+    head, sep, _ = url.partition("/read/")
+    return head if sep else url
+
+def optimize_png(path: str) -> None:
+    # Lossless recompression of png in place, called in worker processes.
+    oxipng.optimize(path, level=OXIPNG_LEVEL)
+
+def read_png_size(path: str) -> Tuple[int, int]:
+    # Width and height are stored right after signature in IHDR chunk.
+    # Truncated file counts as zero size, so manga will be failed.
+    with open(path, "rb") as f:
+        f.seek(16)
+        header = f.read(8)
+    if len(header) < 8:
+        return 0, 0
+    return struct.unpack(">II", header)
+
+class DevTools:
+    """
+    Minimal client of Chrome DevTools protocol over websocket.
+    Commands are sent directly to the page target of browser, skipping
+    the chromedriver hop that execute_cdp_cmd goes through.
+    """
+
+    def __init__(self, browser: webdriver.Chrome, timeout: float = DEVTOOLS_TIMEOUT):
+        """
+        param: browser -- webdriver.Chrome
+            Running browser, its page target is found via debugger address
+        param: timeout -- float
+            Timeout in seconds for connecting and for every answer of Chrome
+        """
+        address = browser.capabilities["goog:chromeOptions"]["debuggerAddress"]
+        with urllib.request.urlopen(f"http://{address}/json", timeout=timeout) as response:
+            targets = [t for t in json.load(response) if t["type"] == "page"]
+        # Window handle of chromedriver contains id of target
+        handle = browser.current_window_handle
+        target = next((t for t in targets if t["id"] in handle), None)
+        if target is None:
+            raise LookupError(f"DevTools target of window {handle} is not found")
+        self.ws = websocket.create_connection(
+            target["webSocketDebuggerUrl"], timeout=timeout, suppress_origin=True
+        )
+        self.last_id = 0
+
+    def send(self, method: str, params: dict) -> dict:
+        """
+        Send command and wait for its result
+        ---------------------------
+        param: method -- string
+            DevTools command, e.g. Page.captureScreenshot
+        param: params -- dict
+            Parameters of command
+        return: dict
+            Result of command
+        """
+        self.last_id += 1
+        self.ws.send(json.dumps({"id": self.last_id, "method": method, "params": params}))
+        while True:
+            message = json.loads(self.ws.recv())
+            # Skip events and answers to other commands
+            if message.get("id") != self.last_id:
+                continue
+            if "error" in message:
+                raise RuntimeError(message["error"].get("message", message["error"]))
+            return message["result"]
+
+    def close(self) -> None:
+        self.ws.close()
 
 class FDownloader:
     """
@@ -71,6 +257,7 @@ class FDownloader:
         cookies_file: str = COOKIES_FILE,
         root_manga_dir: str = ROOT_MANGA_DIR,
         driver_path:str = EXEC_PATH,
+        chrome_binary: Optional[str] = CHROME_PATH,
         default_display: List[int] = MAX_DISPLAY_SETTINGS,
         timeout: float = TIMEOUT,
         wait: float = WAIT,
@@ -78,7 +265,9 @@ class FDownloader:
         password: Optional[str] = None,
         _max: Optional[int] = MAX,
         pack: Optional[bool] = False,
-        viewport: Optional[bool] = False
+        viewport: Optional[bool] = False,
+        concurrency: int = CONCURRENCY,
+        optimize: Optional[bool] = False,
     ):
         """
         param: urls_file -- string name of .txt file with urls
@@ -89,6 +278,9 @@ class FDownloader:
             Contains bynary data with cookies
         param: driver_path -- string
             Path to the headless driver
+        param: chrome_binary -- string
+            Path to Chrome or chrome-headless-shell binary for headless browser,
+            None for default Chrome
         param: default_display -- list of two int (width, height)
             Initial display settings. After loading the page, they will be changed
         param: timeout -- float
@@ -101,6 +293,10 @@ class FDownloader:
             Login or email for authentication
         param: password -- string
             Password for authentication
+        param: concurrency -- int
+            Number of headless browsers downloading manga in parallel
+        param: optimize -- bool
+            Recompress downloaded pages with oxipng
         """
         self.urls_file = urls_file
         self.done_file = done_file
@@ -108,7 +304,11 @@ class FDownloader:
         self.cookies_file = cookies_file
         self.root_manga_dir = root_manga_dir
         self.driver_path = driver_path
+        self.chrome_binary = chrome_binary
         self.browser = None
+        # DevTools websocket of browser: None -- not connected yet,
+        # False -- not available, commands go through chromedriver
+        self._devtools = None
         self.default_display = default_display
         self.timeout = timeout
         self.wait = wait
@@ -117,7 +317,28 @@ class FDownloader:
         self.max = _max
         self.pack = pack
         self.viewport = viewport
+        self.concurrency = max(1, concurrency)
+        if optimize and oxipng is None:
+            print("Error: pyoxipng is not installed. Run `pip install pyoxipng` first.")
+            program_exit()
+        self.optimize = optimize
+        self._optimize_pool = None
+        # Time of earliest next reader page navigation, see __get_reader_page
+        self._next_reader_get = 0.0
+        # Position of tqdm bar, differs between parallel workers
+        self.bar_position = 0
+        # Shared between parallel workers for done/fail files and counters
+        self._lock = threading.Lock()
         self.urls = self.__get_urls_list()
+        # Kept open for the whole session. Urls are buffered and appended in
+        # batches, O_APPEND keeps each batch write whole between workers.
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+        self._done_fd = os.open(self.done_file, flags, 0o644)
+        self._fail_fd = os.open(self.fail_file, flags, 0o644)
+        self._done_buf = []
+        self._fail_buf = []
+        self._closed = False
+        atexit.register(self.close)
 
     def init_browser(self, headless: Optional[bool] = False) -> None:
         """
@@ -129,57 +350,63 @@ class FDownloader:
             If False: launch usually browser with GUI(for first authenticate)
         """
         options = webdriver.ChromeOptions()
-        options.add_argument("--force-device-scale-factor=1")
-        if headless:
-            options.add_argument("--headless")
-            options.add_argument("--window-position=-2400,-2400")
-            # Silent output?
-            options.add_argument("--log-level=OFF")
-        options.add_argument(f"user-agent={USER_AGENT}")
+        # chrome-headless-shell can not show GUI for authenticate
+        headless_shell = headless and self.chrome_binary is not None
+        if headless_shell:
+            options.binary_location = self.chrome_binary
+        for flag in self._chrome_flags(headless, self.default_display, headless_shell):
+            options.add_argument(flag)
         self.browser = webdriver.Chrome(
             executable_path=self.driver_path,
             chrome_options=options,
         )
+        # DevTools connection is made on first screenshot
+        self.__close_devtools()
 
-        # Note: not sure if this is actually working, or needs to be called later. Tough to verify.
-        customJs = """
-        // overwrite the `languages` property to use a custom getter
-        Object.defineProperty(navigator, 'languages', {
-          get: function() {
-            return ['en-US', 'en'];
-          },
-        });
-
-        // overwrite the `plugins` property to use a custom getter
-        Object.defineProperty(navigator, 'plugins', {
-          get: function() {
-            // this just needs to have `length > 0`, but we could mock the plugins too
-            return [1, 2, 3, 4, 5];
-          },
-        });
-
-        // Spoof renderer checks
-        const getParameter = WebGLRenderingContext.getParameter;
-        WebGLRenderingContext.prototype.getParameter = function(parameter) {
-          // UNMASKED_VENDOR_WEBGL
-          if (parameter === 37445) {
-            return 'Intel Open Source Technology Center';
-          }
-          // UNMASKED_RENDERER_WEBGL
-          if (parameter === 37446) {
-            return 'Mesa DRI Intel(R) Ivybridge Mobile ';
-          }
-
-          return getParameter(parameter);
-        };
-        """
-
-        self.browser.execute_script(customJs)
+        self.__add_stealth_script()
 
         if not headless:
             self.__auth()
+        # Headless browsers are launched with default display size, browser
+        # with GUI is only used for login, see _chrome_flags
         self.__set_cookies()
-        self.browser.set_window_size(*self.default_display)
+
+    @staticmethod
+    def _chrome_flags(
+        headless: bool, window_size: List[int], headless_shell: bool = False
+    ) -> List[str]:
+        """
+        Command line flags for Chrome
+        ---------------------
+        param: headless -- bool
+            If True: flags for headless browser with background work disabled
+        param: window_size -- list of two int (width, height)
+            Initial window size of headless browser, browser with GUI
+            keeps default size so login form fits on screen
+        param: headless_shell -- bool
+            If True: binary is chrome-headless-shell, which has no new headless mode
+        return: list
+            List of flags
+        """
+        flags = ["--force-device-scale-factor=1"]
+        if headless:
+            flags += [
+                "--headless" if headless_shell else "--headless=new",
+                f"--window-size={window_size[0]},{window_size[1]}",
+                "--window-position=-2400,-2400",
+                # Silent output?
+                "--log-level=OFF",
+                "--disable-dev-shm-usage",
+                "--disable-extensions",
+                "--disable-background-networking",
+                "--disable-sync",
+                "--disable-translate",
+                "--mute-audio",
+                "--no-first-run",
+                "--hide-scrollbars",
+            ]
+        flags.append(f"user-agent={USER_AGENT}")
+        return flags
 
     def __set_cookies(self) -> None:
         self.browser.get(LOGIN_URL)
@@ -190,15 +417,43 @@ class FDownloader:
                     cookie["expiry"] = int(cookie["expiry"])
                     self.browser.add_cookie(cookie)
 
+    def _soft_reset_browser(self) -> None:
+        """
+        Reset cookies and cache of running browser after failed manga.
+        Much cheaper than closing and launching Chrome again.
+        """
+        self.browser.switch_to.default_content()
+        self.browser.delete_all_cookies()
+        self.browser.execute_cdp_cmd("Network.clearBrowserCache", {})
+        self.__set_cookies()
+        if self.viewport:
+            # Only -v mode resizes window during download
+            self.browser.set_window_size(*self.default_display)
+
     def __init_headless_browser(self) -> None:
         """
         Recreating browser in headless mode(without GUI)
         """
         options = Options()
-        options.headless = True
+        if self.chrome_binary is not None:
+            options.binary_location = self.chrome_binary
+        for flag in self._chrome_flags(True, self.default_display, self.chrome_binary is not None):
+            options.add_argument(flag)
         self.browser = webdriver.Chrome(
             executable_path=self.driver_path, chrome_options=options
         )
+        self.__close_devtools()
+        self.__add_stealth_script()
+
+    def __add_stealth_script(self) -> None:
+        """
+        Register STEALTH_JS in just launched browser. Evaluated by Chrome
+        in every new document and frame before page scripts, so it
+        survives navigation.
+        """
+        self.browser.execute_cdp_cmd(
+            "Page.addScriptToEvaluateOnNewDocument", {"source": STEALTH_JS}
+        )
 
     def __auth(self) -> None:
         """
@@ -233,133 +488,416 @@ class FDownloader:
         # print(window_size)
         self.browser.set_window_size(*window_size)
 
+    def __close_devtools(self) -> None:
+        """
+        Close DevTools websocket of browser if it is open, next screenshot
+        will connect again
+        """
+        if self._devtools:
+            try:
+                self._devtools.close()
+            except (OSError, websocket.WebSocketException):
+                pass
+        self._devtools = None
+
+    def _cdp_screenshot(self, clip: dict) -> str:
+        """
+        Take screenshot of `clip` region via DevTools Page.captureScreenshot.
+        Unlike save_screenshot it lets Chrome crop the page itself.
+        Goes over direct DevTools websocket if websocket-client is installed,
+        otherwise through chromedriver.
+        ---------------------------
+        param: clip -- dict
+            Region of page with keys x, y, width, height, scale
+        return: string
+            Base64 encoded png
+        """
+        params = {"format": "png", "clip": clip, "captureBeyondViewport": True}
+        if self._devtools is None and websocket is not None:
+            try:
+                self._devtools = DevTools(self.browser)
+            except (OSError, KeyError, LookupError, websocket.WebSocketException):
+                # Debugger address is not reachable, stay with chromedriver
+                self._devtools = False
+        if self._devtools:
+            try:
+                return self._devtools.send("Page.captureScreenshot", params)["data"]
+            except (OSError, websocket.WebSocketException):
+                self.__close_devtools()
+                self._devtools = False
+        result = self.browser.execute_cdp_cmd("Page.captureScreenshot", params)
+        return result["data"]
+
+    @staticmethod
+    def _write_png(path: str, data: str) -> None:
+        """
+        Decode base64 png and write it to file in binary mode.
+        Called from the writer thread of `load_all`.
+        """
+        with open(path, "wb") as f:
+            f.write(base64.b64decode(data))
+
+    @staticmethod
+    def _store_file(archive: ZipFile, path: str, arcname: str) -> None:
+        """
+        Store file in archive without compression. Same as ZipFile.write,
+        but copies with COPY_BUFFER_SIZE chunks instead of 8 KiB ones, so
+        a page is passed through crc32 and write in a few big calls.
+        """
+        zinfo = ZipInfo.from_file(path, arcname)
+        zinfo.compress_type = ZIP_STORED
+        with open(path, "rb") as src, archive.open(zinfo, "w") as dst:
+            copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
     def load_all(self) -> None:
         """
         Just main function which opening each page and save it in .png
         """
-
-        self.browser.set_window_size(*self.default_display)
         if not os.path.exists(self.root_manga_dir):
             os.mkdir(self.root_manga_dir)
 
+        if self.optimize:
+            # Pages are recompressed in other processes while next manga downloads
+            self._optimize_pool = ProcessPoolExecutor()
+        try:
+            if self.concurrency > 1:
+                self.__load_all_parallel()
+                return
 
-        urls_processed = 0
+            urls_processed = 0
+            for url in self.urls:
+                # If `url` is an empty string, skip it.
+                if not url.strip():
+                    continue
+
+                if self._download_one(url):
+                    urls_processed += 1
+                if self.max is not None and urls_processed >= self.max:
+                    break
+        finally:
+            if self._optimize_pool is not None:
+                # Waits for pending pages, their manga are recorded as done meanwhile
+                self._optimize_pool.shutdown(wait=True)
+                self._optimize_pool = None
+
+    def __load_all_parallel(self) -> None:
+        """
+        Distribute urls between `concurrency` headless browsers.
+        Current browser is the first worker, others are shallow copies
+        of downloader with own browser instance. Manga are independent,
+        so each worker takes next url from the shared queue.
+        """
+        urls = queue.Queue()
         for url in self.urls:
-            # If `url` is an empty string, skip it.
-            if not url.strip():
-                continue
+            if url.strip():
+                urls.put(url)
+
+        workers = [self]
+        for i in range(1, self.concurrency):
+            worker = copy.copy(self)
+            worker.browser = None
+            worker._devtools = None
+            worker.bar_position = i
+            workers.append(worker)
 
-            # Sanitize url.
-            url = sanitize_url(url)
+        urls_processed = 0
+        # Set when any worker fails (e.g. program_exit on timeout), others stop
+        # taking new urls
+        stop = threading.Event()
 
-            self.browser.get(url)
-            self.waiting_loading_page(is_reader_page=False)
+        def run(worker: "FDownloader") -> None:
+            nonlocal urls_processed
             try:
-                page_count = self.__get_page_count(self.browser.page_source)
-            except ValueError:
-                self.add_failed(url)
-                continue
+                if worker.browser is None:
+                    worker.init_browser(headless=True)
+                while not stop.is_set():
+                    with self._lock:
+                        if self.max is not None and urls_processed >= self.max:
+                            return
+                    try:
+                        url = urls.get_nowait()
+                    except queue.Empty:
+                        return
+                    if worker._download_one(url):
+                        with self._lock:
+                            urls_processed += 1
+            except BaseException:
+                stop.set()
+                raise
+            finally:
+                if worker is not self and worker.browser is not None:
+                    worker.__close_devtools()
+                    worker.browser.quit()
 
-            manga_name = url.split("/")[-1]
-            manga_folder = os.sep.join([self.root_manga_dir, manga_name])
-            if not os.path.exists(manga_folder):
-                os.mkdir(manga_folder)
-
-            print(f'Downloading "{manga_name}" manga.')
-            delay_before_fetching = True  # When fetching the first page, multiple pages load and the reader slows down
-
-        
-            bar_format="{desc}: {percentage:3.0f}% |{bar}| {n:3.0f}/{total:3.0f}"
-            ascii=" ="
-            for page_num in tqdm(range(1, page_count + 1), ascii=ascii, bar_format=bar_format):
-                destination_file = os.sep.join([manga_folder, f"{page_num}.png"])
-                if os.path.isfile(destination_file):
-                    delay_before_fetching = True  # When skipping files, the reader will load multiple pages and slow down again
-                    continue
+        pool = ThreadPoolExecutor(max_workers=len(workers))
+        futures = [pool.submit(run, worker) for worker in workers]
+        try:
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            for future in done:
+                if future.exception() is not None:
+                    raise future.exception()
+        except BaseException:
+            # Worker failure or Ctrl-C in main thread, workers stop after current
+            # manga and are waited for, so done/fail files are still open for them
+            stop.set()
+            pool.shutdown(wait=True)
+            raise
+        pool.shutdown(wait=True)
+
+    def _download_one(self, url: str) -> bool:
+        """
+        Download all pages of one manga with current browser
+        ---------------------------
+        param: url -- string
+            Url of manga
+        return: bool
+            True if manga was downloaded successfully
+        """
+        # Sanitize url.
+        url = sanitize_url(url)
+
+        self.browser.get(url)
+        self.waiting_loading_page(is_reader_page=False)
+        try:
+            page_count = self.__get_page_count(self.browser.page_source)
+        except ValueError:
+            self.add_failed(url)
+            return False
 
-                self.browser.get(f"{url}/read/page/{page_num}")
+        manga_name = url.split("/")[-1]
+        manga_folder = os.sep.join([self.root_manga_dir, manga_name])
+        # Page paths are built from this prefix, f"{prefix}{page_num}.png"
+        prefix = f"{manga_folder}{os.sep}"
+        if not os.path.exists(manga_folder):
+            os.mkdir(manga_folder)
+
+        print(f'Downloading "{manga_name}" manga.')
+        # Pages left from previous run are not opened in browser at all
+        have = {
+            int(entry.name[:-4])
+            for entry in os.scandir(manga_folder)
+            if entry.name.endswith(".png") and entry.name[:-4].isdigit()
+        }
+        missing = [page_num for page_num in range(1, page_count + 1) if page_num not in have]
+        prev_page_num = None
+
+    
+        bar_format="{desc}: {percentage:3.0f}% |{bar}| {n:3.0f}/{total:3.0f}"
+        ascii=" ="
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            for page_num in tqdm(
+                missing,
+                total=page_count,
+                initial=page_count - len(missing),
+                ascii=ascii,
+                bar_format=bar_format,
+                position=self.bar_position,
+            ):
+                destination_file = f"{prefix}{page_num}.png"
+                # When fetching the first page or after skipped pages, multiple pages
+                # load and the reader slows down
+                delay_before_fetching = prev_page_num is None or page_num != prev_page_num + 1
+                prev_page_num = page_num
+
+                self.__get_reader_page(f"{url}/read/page/{page_num}", delay_before_fetching)
                 self.waiting_loading_page(
                     is_reader_page=True, should_add_delay=delay_before_fetching
                 )
-                delay_before_fetching = False
 
-                # Count of leyers may be 2 or 3 therefore we get different target layer
-                n = self.browser.execute_script(
-                    "return document.getElementsByClassName('layer').length"
-                )
                 try:
-                    # Resizing window size for exactly manga page size
-                    width = self.browser.execute_script(
-                        f"return document.getElementsByTagName('canvas')[{n-2}].width"
-                    )
-                    height = self.browser.execute_script(
-                        f"return document.getElementsByTagName('canvas')[{n-2}].height"
+                    # Read manga page position and size and delete all UI in one round trip
+                    x, y, rect_width, rect_height, width, height = self.browser.execute_script(
+                        PAGE_SIZE_JS
                     )
                     if self.viewport:
+                        # Resizing viewport for exactly manga page size
                         self.set_viewport_size(width, height)
-                    else: 
-                        self.browser.set_window_size(width, height)
+                        clip = {"x": 0, "y": 0, "width": width, "height": height, "scale": 1}
+                    else:
+                        # Crop canvas from page as is, reader may show it scaled down,
+                        # so it is scaled back to real canvas size
+                        clip = {
+                            "x": x,
+                            "y": y,
+                            "width": rect_width,
+                            "height": rect_height,
+                            "scale": width / rect_width if rect_width else 1,
+                        }
 
                 except JavascriptException:
                     print(
                         "\nSome error with JS. Page source are note ready. You can try increase argument -t"
                     )
+                    # Fall back to whatever the window currently shows
+                    size = self.browser.get_window_size()
+                    clip = {"x": 0, "y": 0, "width": size["width"], "height": size["height"], "scale": 1}
 
-                # Delete all UI and save page
-                self.browser.execute_script(
-                    f"document.getElementsByClassName('layer')[{n-1}].remove()"
-                )
-                
-                self.browser.save_screenshot(destination_file)
-
-            # Check every file page for size.
-            failed = False
-            for page_num in range(1, page_count + 1):
-                destination_file = os.sep.join([manga_folder, f"{page_num}.png"])
-                img = Image.open(destination_file)
-                if img.width < FAIL_THRESHOLD or img.height < FAIL_THRESHOLD:
-                    failed = True
-                img.close()
-            if failed: 
-                self.add_failed(url)
-                self.remove_manga_folder(manga_folder, page_count)
-                # Reinit browser!
-                self.browser.close()
-                self.init_browser(headless=True)
-                continue
+                data = self._cdp_screenshot(clip)
+                # Decoding and writing happen in background while next page loads
+                pending.append(writer.submit(self._write_png, destination_file, data))
+                if len(pending) > MAX_PENDING_WRITES:
+                    pending.popleft().result()
+            for future in pending:
+                future.result()
 
+        # Check every file page for size.
+        failed = False
+        for page_num in range(1, page_count + 1):
+            destination_file = f"{prefix}{page_num}.png"
+            width, height = read_png_size(destination_file)
+            if width < FAIL_THRESHOLD or height < FAIL_THRESHOLD:
+                failed = True
+        if failed: 
+            self.add_failed(url)
+            self.remove_manga_folder(manga_folder, page_count)
+            # Reset browser state instead of relaunching it
+            self._soft_reset_browser()
+            return False
+
+        if self._optimize_pool is not None:
+            files = [
+                f"{prefix}{page_num}.png"
+                for page_num in range(1, page_count + 1)
+            ]
+            futures = [self._optimize_pool.submit(optimize_png, file) for file in files]
             if self.pack:
-                zipname = os.sep.join([self.root_manga_dir , f"{manga_name}.cbz"])
-                with ZipFile(zipname, "w") as archive:
-                    for page_num in range(1, page_count + 1):
-                        file = os.sep.join([manga_folder, f"{page_num}.png"])
-                        archive.write(file, f"{page_num}.png", None, ZIP_STORED)
-                if os.path.exists(zipname):
-                    self.remove_manga_folder(manga_folder, page_count)
+                # Pages have to be optimized before they go into .cbz, failed
+                # pages are reported and packed as they were downloaded
+                for future in futures:
+                    future.add_done_callback(
+                        lambda future: self._report_optimize_error(url, future)
+                    )
+                wait(futures)
+            else:
+                # Manga is recorded as done only after all its pages are optimized
+                self.__add_done_after(url, futures)
+                return True
+
+        if self.pack:
+            zipname = os.sep.join([self.root_manga_dir , f"{manga_name}.cbz"])
+            files = [f"{prefix}{page_num}.png" for page_num in range(1, page_count + 1)]
+            with ZipFile(zipname, "w", ZIP_STORED, allowZip64=True) as archive:
+                for page_num, file in enumerate(files, 1):
+                    self._store_file(archive, file, f"{page_num}.png")
+            # Pages are deleted only when archive is completely written
+            for file in files:
+                os.unlink(file)
+            try:
+                os.rmdir(manga_folder)
+            except OSError:
+                # Folder still has files which are not manga pages
+                pass
+
+        self.add_done(url)
+        return True
+
+    @staticmethod
+    def _report_optimize_error(url: str, future: Future) -> None:
+        """
+        Print error of finished optimization job of manga page, if any
+        """
+        if future.exception() is not None:
+            print(f"\nError: Failed to optimize page of {url}: {future.exception()}")
 
+    def __add_done_after(self, url: str, futures: List[Future]) -> None:
+        """
+        Record manga as done when all optimization jobs of its pages finish.
+        Failed jobs are reported, page stays as it was downloaded.
+        """
+        if not futures:
             self.add_done(url)
-            urls_processed += 1
-            if self.max is not None and urls_processed >= self.max:
-                break
+            return
+        remaining = len(futures)
+        counter_lock = threading.Lock()
+
+        def on_done(future: Future) -> None:
+            nonlocal remaining
+            self._report_optimize_error(url, future)
+            with counter_lock:
+                remaining -= 1
+                last = remaining == 0
+            if last:
+                self.add_done(url)
+
+        for future in futures:
+            future.add_done_callback(on_done)
 
     def remove_manga_folder(self, manga_folder: str, page_count: int):
+        prefix = f"{manga_folder}{os.sep}"
         for page_num in range(1, page_count + 1):
-            file = os.sep.join([manga_folder, f"{page_num}.png"])
+            file = f"{prefix}{page_num}.png"
             if os.path.exists(file):
                 os.remove(file)
         os.rmdir(manga_folder)
 
     def add_done(self, url: str):
         # print(f"Manga done! \[T]/")
-        file_obj = open(self.done_file, "a")
-        file_obj.write(f"{url}\n")
-        file_obj.close()
+        with self._lock:
+            if self._closed:
+                print(f"\nError: done file is closed, {url} is not recorded")
+                return
+            self.done.add(url)
+            self._done_buf.append(url)
+            # Packed manga has no pages left on disk, lost done entry would
+            # mean downloading it again, so it is written right away
+            if self.pack or len(self._done_buf) >= FLUSH_EVERY:
+                self._write_urls(self._done_fd, self._done_buf)
 
     def add_failed(self, url: str):
         print(f"Error: Failed {url}")
-        fail_file_obj = open(self.fail_file, "a")
-        fail_file_obj.write(f"{url}\n")
-        fail_file_obj.close()
+        with self._lock:
+            if self._closed:
+                print(f"\nError: fail file is closed, {url} is not recorded")
+                return
+            self.failed.add(url)
+            self._fail_buf.append(url)
+            if len(self._fail_buf) >= FLUSH_EVERY:
+                self._write_urls(self._fail_fd, self._fail_buf)
+
+    @staticmethod
+    def _write_urls(fd: int, urls: List[str]) -> None:
+        """
+        Append buffered urls to file and empty the buffer.
+        Must be called with self._lock held and files not closed.
+        """
+        if urls:
+            data = "".join(f"{url}\n" for url in urls).encode()
+            while data:
+                data = data[os.write(fd, data):]
+            urls.clear()
+
+    def flush(self) -> None:
+        """
+        Write buffered done and fail urls to their files
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._write_urls(self._done_fd, self._done_buf)
+            self._write_urls(self._fail_fd, self._fail_buf)
+
+    def close(self) -> None:
+        """
+        Flush and close done and fail files opened for the session.
+        Also called at program exit, so can be called twice.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._write_urls(self._done_fd, self._done_buf)
+            self._write_urls(self._fail_fd, self._fail_buf)
+            os.close(self._done_fd)
+            os.close(self._fail_fd)
+            # Set together with closing fds, so writers never see freed fd numbers
+            self._closed = True
+        self.__close_devtools()
+
+    def __enter__(self) -> "FDownloader":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
 
     def load_urls_from_collection(self, collection_url: str) -> None:
         """
@@ -374,9 +912,12 @@ class FDownloader:
                 if page_num != 1:
                     self.browser.get(f"{collection_url}/page/{page_num}")
                     self.waiting_loading_page(is_reader_page=False)
-                soup = bs(self.browser.page_source, "html.parser")
-                for div in soup.find_all("div", attrs={"class": "col-comic"}):
-                    f.write(f"{BASE_URL}{div.find('a')['href']}\n")
+                doc = lxml.html.fromstring(self.browser.page_source)
+                hrefs = doc.xpath(
+                    "//div[contains(concat(' ', normalize-space(@class), ' '), ' col-comic ')]"
+                    "/descendant::a[1]/@href"
+                )
+                f.writelines([f"{BASE_URL}{href}\n" for href in hrefs])
 
     def __get_page_count(self, page_source: str) -> int:
         """
@@ -388,7 +929,7 @@ class FDownloader:
             Number of manga pages
         """
         # print(type(page_source))
-        match = re.search(r"\"\>(\d+) page(s?)\<\/div\>", page_source)
+        match = PAGE_COUNT_RE.search(page_source)
         if match:
             return int(match.group(1))
         else:
@@ -403,22 +944,11 @@ class FDownloader:
         return: int
             Number of collection pages
         """
-        soup = bs(page_source, "html.parser")
-        page_count = 1
-        try:
-            # Search for page links
-            page_links=soup.find_all('a', {'href': re.compile(r"/page/(\d+)")})
- 
-            # If there are multiple pages...
-            if len(page_links) > 0:
-                # Find the maximum page number listed in link URLs
-                page_count=max([
-                        int(re.search(r"\/page\/(\d+)", pg['href']).group(1))
-                        for pg in page_links
-                    ])
-        except Exception as ex:
-            print(ex)
-        return page_count
+        # Search for page links and find the maximum page number listed in them
+        return max(
+            (int(match.group(1)) for match in PAGE_LINK_RE.finditer(page_source)),
+            default=1,
+        )
 
     def __get_urls_list(self) -> List[str]:
         """
@@ -427,25 +957,36 @@ class FDownloader:
         return: urls -- list
             List of urls from urls_file
         """
-        done = []
         with open(self.done_file, "r") as donef:
-            for line in donef:
-                done.append(line.replace("\n", ""))
-                
-        failed = []
+            self.done = set(map(str.rstrip, donef))
+
         with open(self.fail_file, "r") as failf:
-            for line in failf:
-                failed.append(line.replace("\n", ""))
+            self.failed = set(map(str.rstrip, failf))
 
         urls = []
+        seen = set()
         with open(self.urls_file, "r") as f:
             for line in f:
-                clean_line = line.replace("\n", "")
-                clean_line = sanitize_url(clean_line)
-                if clean_line not in done and clean_line not in failed and clean_line not in urls:
+                clean_line = sanitize_url(line.rstrip())
+                if clean_line not in self.done and clean_line not in self.failed and clean_line not in seen:
+                    seen.add(clean_line)
                     urls.append(clean_line)
         return urls
 
+    def __get_reader_page(self, read_url: str, should_add_delay: bool) -> None:
+        """
+        Open reader page. When reader pages are polled instead of fixed sleep,
+        -w is still kept as minimal interval between reader navigations
+        (3 times -w after first page), so fast render skips only the rest
+        of it and page requests stay throttled.
+        """
+        if not FIXED_WAIT:
+            delay = self._next_reader_get - monotonic()
+            if delay > 0:
+                sleep(delay)
+        self.browser.get(read_url)
+        self._next_reader_get = monotonic() + (self.wait * 3 if should_add_delay else self.wait)
+
     def waiting_loading_page(
         self,
         is_reader_page: bool = False,
@@ -465,6 +1006,10 @@ class FDownloader:
             sleep(self.wait)
             elem_xpath = "//link[@rel='icon']"
             iframe = False
+        elif not FIXED_WAIT:
+            # Reader pages are polled until canvas is rendered, no fixed sleep
+            elem_xpath = "//div[@data-name='PageView']"
+            iframe = True
         elif should_add_delay:
             sleep(self.wait * 3)
             elem_xpath = "//div[@data-name='PageView']"
@@ -475,7 +1020,10 @@ class FDownloader:
             iframe = True
         try:
             # We need to switch into iframe before looking for canvas.
-            if iframe:
+            if iframe and not FIXED_WAIT:
+                frame = EC.frame_to_be_available_and_switch_to_it((By.TAG_NAME, "iframe"))
+                WebDriverWait(self.browser, self.timeout).until(frame)
+            elif iframe:
                 try:
                     self.browser.switch_to.frame(self.browser.find_element_by_tag_name("iframe"))
                 except NoSuchElementException:
@@ -492,3 +1040,12 @@ class FDownloader:
                 You can try increase param -t for more delaying."
             )
             program_exit()
+
+        if iframe and not FIXED_WAIT:
+            try:
+                WebDriverWait(self.browser, self.timeout).until(
+                    lambda driver: driver.execute_script(PAGE_READY_JS, FAIL_THRESHOLD)
+                )
+            except TimeoutException:
+                # Page may be really small, size check after download will decide
+                pass
@@ -15,6 +15,8 @@ from downloader import (
     ROOT_MANGA_DIR,
     MAX,
     EXEC_PATH,
+    CHROME_PATH,
+    CONCURRENCY,
 )
 
 
@@ -28,6 +30,14 @@ def main():
         help=f"Binary with chromedriver \
             By default -- {EXEC_PATH}",
     )
+    argparser.add_argument(
+        "-s",
+        "--chrome_binary",
+        type=str,
+        default=CHROME_PATH,
+        help=f"Chrome binary for headless browser, e.g. chrome-headless-shell \
+            By default -- Chrome found by chromedriver",
+    )
     argparser.add_argument(
         "-z",
         "--collection_url",
@@ -104,7 +114,10 @@ def main():
         type=float,
         default=WAIT,
         help=f"Wait time in seconds for pauses beetween downloading pages \
-            Increase this argument if you become blocked. By default -- {WAIT} sec",
+            Increase this argument if you become blocked. \
+            Reader pages are polled until rendered, with this wait as minimal interval \
+            between them, unless FAKKU_FIXED_WAIT is set. \
+            By default -- {WAIT} sec",
     )
     argparser.add_argument(
         "-m",
@@ -114,17 +127,34 @@ def main():
         help=f"Max number of volumes to download at once \
             Set this argument if you become blocked. By default -- No limit",
     )
+    argparser.add_argument(
+        "-n",
+        "--concurrency",
+        type=int,
+        default=CONCURRENCY,
+        help=f"Number of headless browsers downloading manga in parallel \
+            Each browser takes whole manga, so -m may be exceeded by manga in progress. \
+            By default -- {CONCURRENCY}",
+    )
     argparser.add_argument(
         "-k",
         "--pack",
         action='store_true',
         help=f"Flags if manga should be packed into .cbz when finished. Compression algorithm is STORED",
     )
+    argparser.add_argument(
+        "-O",
+        "--optimize",
+        action='store_true',
+        help=f"Flags if pages should be losslessly recompressed with oxipng after download. \
+            Requires pyoxipng package.",
+    )
     argparser.add_argument(
         "-v",
         "--viewport",
         action='store_true',
-        help=f"Flags if page size should be applied to browser, or rather viewport. Experimental.",
+        help=f"Flags if viewport should be resized to page size before capture, \
+            instead of cropping page canvas from the window. Experimental.",
     )
     args = argparser.parse_args()
 
@@ -145,6 +175,7 @@ def main():
 
     loader = FDownloader(
         driver_path=args.binary,
+        chrome_binary=args.chrome_binary,
         urls_file=args.file_urls,
         done_file=args.done_file,
         fail_file=args.fail_file,
@@ -156,23 +187,26 @@ def main():
         wait=args.wait,
         _max=args.max,
         pack=args.pack,
-        viewport=args.viewport
+        viewport=args.viewport,
+        concurrency=args.concurrency,
+        optimize=args.optimize,
     )
 
-    if not Path(args.cookies_file).is_file():
-        print(
-            f"Cookies file({args.cookies_file}) are not detected. Please, "
-            + "login in next step for generate cookie for next runs."
-        )
-        loader.init_browser(headless=False)
-    else:
-        # print(f"Using cookies file: {args.cookies_file}")
-        loader.init_browser(headless=True)
+    with loader:
+        if not Path(args.cookies_file).is_file():
+            print(
+                f"Cookies file({args.cookies_file}) are not detected. Please, "
+                + "login in next step for generate cookie for next runs."
+            )
+            loader.init_browser(headless=False)
+        else:
+            # print(f"Using cookies file: {args.cookies_file}")
+            loader.init_browser(headless=True)
 
-    if args.collection_url:
-        loader.load_urls_from_collection(args.collection_url)
-    else:
-        loader.load_all()
+        if args.collection_url:
+            loader.load_urls_from_collection(args.collection_url)
+        else:
+            loader.load_all()
 
 
 if __name__ == "__main__":